@@ -2,22 +2,54 @@
 """
 Borgmatic Statistics Collector
 Collects backup statistics from Borgmatic running in Docker and stores them in PostgreSQL
+
+Each run is stored in a single transaction with synchronous_commit turned off
+for that transaction only. A database crash right after a run can therefore
+lose that run's statistics, but never leaves them partially written; the next
+hourly run collects them again.
 """
 
+import hashlib
 import json
+import shlex
 import subprocess
 import re
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import Json
 from datetime import datetime
 import logging
 import sys
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+import ijson
 import yaml
-from typing import Dict, List, Optional, Tuple
+from typing import Any, Dict, Generator, List, Optional, Tuple
+
+try:
+    import orjson
+    HAS_ORJSON = True
+except ImportError:
+    HAS_ORJSON = False
+
+
+def json_loads(data: bytes) -> Any:
+    """Parse JSON with orjson when available, falling back to the stdlib"""
+    if HAS_ORJSON:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def json_dumps(obj: Any, sort_keys: bool = False) -> str:
+    """Serialise JSON with orjson when available, falling back to the stdlib"""
+    if HAS_ORJSON:
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS if sort_keys else 0).decode()
+    return json.dumps(obj, sort_keys=sort_keys)
+
 
 # Configuration
-DB_CONFIG = {
+DB_CONFIG: Dict[str, Any] = {
     'host': os.getenv('POSTGRES_HOST', 'localhost'),
     'port': os.getenv('POSTGRES_PORT', 5432),
     'database': os.getenv('POSTGRES_DB', 'borgmatic_stats'),
@@ -28,6 +60,21 @@ DB_CONFIG = {
 # Docker container name
 DOCKER_CONTAINER = os.getenv('BORGMATIC_CONTAINER', 'borgmatic')
 
+# Database dump files in a borg listing, in borg's default format:
+# "{mode} {user} {group} {size} {mtime} {path}". Only regular files match.
+DATABASE_DUMP_RE = re.compile(
+    rb'^-\S*[ \t]+\S+[ \t]+\S+[ \t]+(\d+)[ \t].*?'
+    rb'(\S*borgmatic/(mariadb|postgresql)_databases/(?:([^/\n]+)/)?([^/\n]+))$',
+    re.M
+)
+
+# Marker written after each command sent to the persistent container shell
+SHELL_SENTINEL = b'__ASSIMILATE_EOF__'
+
+# Borgmatic config location inside the container and local parse cache
+BORGMATIC_CONFIG_PATH = '/etc/borgmatic.d/config.yaml'
+CONFIG_CACHE_PATH = os.getenv('CONFIG_CACHE_PATH', '/var/cache/assimilate/config.json')
+
 # Logging setup
 logging.basicConfig(
     level=logging.INFO,
@@ -35,23 +82,87 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Prefer the libyaml-backed loader when PyYAML was built with it
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
 
 class BorgmaticStatsCollector:
-    def __init__(self):
-        self.conn = None
-        self.cursor = None
+    def __init__(self) -> None:
+        self.conn: Any = None
+        self.cursor: Any = None
+        self.idle_shells: List[subprocess.Popen] = []
+        self.shells_lock = threading.Lock()
         
-    def connect_db(self):
+    def connect_db(self) -> None:
         """Establish database connection"""
         try:
             self.conn = psycopg2.connect(**DB_CONFIG)
-            self.cursor = self.conn.cursor(cursor_factory=RealDictCursor)
+            self.conn.autocommit = False
+            self.cursor = self.conn.cursor()
             logger.info("Connected to PostgreSQL database")
         except Exception as e:
             logger.error(f"Failed to connect to database: {e}")
             sys.exit(1)
+        
+        try:
+            self.ensure_collector_state()
+            self.prepare_statements()
+        except Exception as e:
+            logger.error(f"Failed to prepare database: {e}")
+            sys.exit(1)
+    
+    def ensure_collector_state(self) -> None:
+        """Create the collector_state table on databases initialised before it existed"""
+        self.cursor.execute("""
+            CREATE TABLE IF NOT EXISTS collector_state (
+                repository_id INTEGER PRIMARY KEY REFERENCES repositories(id) ON DELETE CASCADE,
+                last_info_hash VARCHAR(64),
+                updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        # Commit on its own so a rolled-back collection run cannot undo it
+        self.conn.commit()
+    
+    def prepare_statements(self) -> None:
+        """Prepare the hot insert statements server-side"""
+        # Archives arrive as borgmatic's JSON array and are expanded into
+        # rows by Postgres, with columns named after borgmatic's JSON keys
+        self.cursor.execute("""
+            PREPARE assim_archives (integer, json) AS
+            INSERT INTO backup_archives (
+                repository_id, archive_name, archive_hash, hostname,
+                username, comment, created_at, end_time, duration_seconds,
+                original_size_bytes, compressed_size_bytes, deduplicated_size_bytes,
+                number_of_files
+            )
+            SELECT $1, a.name, a.id, a.hostname,
+                a.username, COALESCE(a.comment, ''), a.start, a."end", a.duration,
+                (a.stats->>'original_size')::bigint,
+                (a.stats->>'compressed_size')::bigint,
+                (a.stats->>'deduplicated_size')::bigint,
+                (a.stats->>'nfiles')::integer
+            FROM json_to_recordset($2) AS a(
+                name text, id text, hostname text, username text, comment text,
+                start timestamptz, "end" timestamptz, duration numeric, stats json
+            )
+            ON CONFLICT (repository_id, archive_hash) 
+            DO UPDATE SET recorded_at = CURRENT_TIMESTAMP
+            RETURNING id, archive_hash
+        """)
+        self.cursor.execute("""
+            PREPARE assim_database_backups (integer, text[], text[], text[], bigint[], text[]) AS
+            INSERT INTO database_backups (
+                archive_id, database_type, database_name,
+                hostname, size_bytes, backup_path
+            )
+            SELECT $1, db.database_type, db.database_name,
+                db.hostname, db.size_bytes, db.backup_path
+            FROM unnest($2, $3, $4, $5, $6) AS db(
+                database_type, database_name, hostname, size_bytes, backup_path
+            )
+        """)
     
-    def close_db(self):
+    def close_db(self) -> None:
         """Close database connection"""
         if self.cursor:
             self.cursor.close()
@@ -59,51 +170,158 @@ class BorgmaticStatsCollector:
             self.conn.close()
         logger.info("Database connection closed")
     
-    def run_docker_command(self, command: str) -> str:
-        """Execute command in Docker container"""
-        full_command = f"docker exec {DOCKER_CONTAINER} {command}"
+    def start_docker_shell(self) -> subprocess.Popen:
+        """Start a persistent shell in the Docker container to relay commands through"""
+        shell = subprocess.Popen(
+            ['docker', 'exec', '-i', DOCKER_CONTAINER, 'sh'],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE
+        )
+        logger.info(f"Started persistent shell in container {DOCKER_CONTAINER}")
+        return shell
+    
+    def acquire_docker_shell(self) -> subprocess.Popen:
+        """Take an idle container shell, starting a new one if none is free"""
+        with self.shells_lock:
+            while self.idle_shells:
+                shell = self.idle_shells.pop()
+                if shell.poll() is None:
+                    return shell
+        return self.start_docker_shell()
+    
+    def release_docker_shell(self, shell: subprocess.Popen) -> None:
+        """Return a container shell to the idle pool"""
+        with self.shells_lock:
+            self.idle_shells.append(shell)
+    
+    def close_docker_shell(self, shell: subprocess.Popen) -> None:
+        """Shut down a single container shell"""
         try:
-            result = subprocess.run(
-                full_command,
-                shell=True,
-                capture_output=True,
-                text=True,
-                check=True
-            )
-            return result.stdout
-        except subprocess.CalledProcessError as e:
-            logger.error(f"Command failed: {full_command}")
-            logger.error(f"Error: {e.stderr}")
+            if shell.stdin:
+                shell.stdin.close()
+            shell.wait(timeout=10)
+        except (OSError, subprocess.TimeoutExpired):
+            shell.kill()
+            shell.wait()
+    
+    def stop_docker_shells(self) -> None:
+        """Shut down all idle container shells"""
+        with self.shells_lock:
+            shells, self.idle_shells = self.idle_shells, []
+        for shell in shells:
+            self.close_docker_shell(shell)
+    
+    def run_docker_command(self, args: List[str]) -> Optional[bytes]:
+        """Execute command in Docker container and return its raw stdout"""
+        command = shlex.join(args)
+        shell = self.acquire_docker_shell()
+        
+        # The leading newline keeps the sentinel on its own line even when the
+        # command output does not end with one; it is stripped again below
+        line = f"{command} </dev/null; printf '\\n{SHELL_SENTINEL.decode()}%s__\\n' \"$?\"\n"
+        assert shell.stdin is not None and shell.stdout is not None
+        try:
+            shell.stdin.write(line.encode())
+            shell.stdin.flush()
+            
+            chunks = []
+            while True:
+                chunk = shell.stdout.readline()
+                if not chunk:
+                    raise OSError("container shell exited unexpectedly")
+                if chunk.startswith(SHELL_SENTINEL):
+                    exit_code = int(chunk[len(SHELL_SENTINEL):].strip().rstrip(b'_'))
+                    break
+                chunks.append(chunk)
+        except (OSError, ValueError) as e:
+            logger.error(f"Command failed: {command}")
+            logger.error(f"Error: {e}")
+            self.close_docker_shell(shell)
+            return None
+        
+        self.release_docker_shell(shell)
+        if exit_code != 0:
+            logger.error(f"Command failed: {command}")
+            logger.error(f"Error: exit status {exit_code}")
             return None
+        return b''.join(chunks)[:-1]
     
-    def get_borgmatic_info(self) -> Optional[List[Dict]]:
-        """Get detailed repository and archive information"""
-        output = self.run_docker_command("borgmatic info --json")
-        if output:
-            try:
-                return json.loads(output)
-            except json.JSONDecodeError:
-                logger.error("Failed to parse borgmatic info JSON")
-        return None
+    def open_borgmatic_info(self) -> subprocess.Popen:
+        """Start borgmatic info in the Docker container with its JSON output piped back"""
+        return subprocess.Popen(
+            ['docker', 'exec', DOCKER_CONTAINER, 'borgmatic', 'info', '--json'],
+            stdout=subprocess.PIPE
+        )
+    
+    def stream_repositories(self, proc: subprocess.Popen) -> Generator[Dict, None, None]:
+        """Yield repository entries from borgmatic info JSON as they are parsed"""
+        assert proc.stdout is not None
+        completed = False
+        try:
+            yield from ijson.items(proc.stdout, 'item', use_float=True)
+            completed = True
+        except ijson.JSONError as e:
+            logger.error(f"Failed to parse borgmatic info JSON: {e}")
+        finally:
+            if not completed:
+                proc.kill()
+            proc.stdout.close()
+            proc.wait()
+        if not completed or proc.returncode != 0:
+            raise RuntimeError(f"borgmatic info failed (exit status {proc.returncode})")
     
     def get_borgmatic_list(self) -> Optional[List[Dict]]:
         """Get list of archives"""
-        output = self.run_docker_command("borgmatic list --json")
+        output = self.run_docker_command(["borgmatic", "list", "--json"])
         if output:
             try:
-                return json.loads(output)
+                return json_loads(output)
             except json.JSONDecodeError:
                 logger.error("Failed to parse borgmatic list JSON")
         return None
     
+    def load_cached_config(self, signature: str) -> Optional[Dict]:
+        """Return cached parsed config if it matches the given mtime/size signature"""
+        try:
+            with open(CONFIG_CACHE_PATH, 'rb') as f:
+                cached = json_loads(f.read())
+            if cached.get('signature') == signature:
+                return cached.get('config')
+        except (OSError, ValueError):
+            pass
+        return None
+    
+    def save_cached_config(self, signature: str, config: Dict) -> None:
+        """Atomically write parsed config to the cache file"""
+        try:
+            os.makedirs(os.path.dirname(CONFIG_CACHE_PATH), exist_ok=True)
+            tmp_path = f"{CONFIG_CACHE_PATH}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump({'signature': signature, 'config': config}, f, default=str)
+            os.replace(tmp_path, CONFIG_CACHE_PATH)
+        except (OSError, TypeError) as e:
+            logger.warning(f"Failed to write config cache: {e}")
+    
     def get_borgmatic_config(self) -> Optional[Dict]:
-        """Get borgmatic configuration"""
-        output = self.run_docker_command("cat /etc/borgmatic.d/config.yaml")
+        """Get borgmatic configuration, reusing the cached parse if unchanged"""
+        stat_output = self.run_docker_command(["stat", "-c", "%Y %s", BORGMATIC_CONFIG_PATH])
+        signature = stat_output.decode().strip() if stat_output else None
+        if signature:
+            config = self.load_cached_config(signature)
+            if config is not None:
+                logger.info("Using cached borgmatic config")
+                return config
+        
+        output = self.run_docker_command(["cat", BORGMATIC_CONFIG_PATH])
         if output:
             try:
-                return yaml.safe_load(output)
+                config = yaml.load(output, Loader=YAML_LOADER)
             except yaml.YAMLError:
                 logger.error("Failed to parse borgmatic config YAML")
+                return None
+            if signature and config is not None:
+                self.save_cached_config(signature, config)
+            return config
         return None
 
     def get_repository_size(self, repo_path: str) -> Optional[int]:
@@ -121,27 +339,27 @@ class BorgmaticStatsCollector:
                     port = match.group(3)
                     remote_path = match.group(4)
 
-                    # Build SSH command
-                    ssh_cmd = f"ssh {user}@{host}"
+                    # Build SSH command; the remote side runs it through a shell
+                    ssh_cmd = ["ssh", f"{user}@{host}"]
                     if port:
-                        ssh_cmd += f" -p {port}"
-                    ssh_cmd += f" du -sb {remote_path}"
+                        ssh_cmd += ["-p", port]
+                    ssh_cmd.append(shlex.join(["du", "-sb", remote_path]))
 
-                    logger.info(f"Getting remote repository size via SSH: {ssh_cmd}")
+                    logger.info(f"Getting remote repository size via SSH: {shlex.join(ssh_cmd)}")
                     output = self.run_docker_command(ssh_cmd)
                     if output:
                         # Parse the output: "1234567\t/path/to/repo"
-                        size_str = output.strip().split('\t')[0]
+                        size_str = output.split(b'\t')[0].strip()
                         return int(size_str)
                 else:
                     logger.warning(f"Cannot parse SSH URL: {repo_path}")
                     return None
             else:
                 # For local repos, get size from within the container
-                output = self.run_docker_command(f"du -sb {repo_path}")
+                output = self.run_docker_command(["du", "-sb", repo_path])
                 if output:
                     # Parse the output: "1234567\t/path/to/repo"
-                    size_str = output.strip().split('\t')[0]
+                    size_str = output.split(b'\t')[0].strip()
                     return int(size_str)
         except Exception as e:
             logger.error(f"Failed to get repository size for {repo_path}: {e}")
@@ -149,270 +367,267 @@ class BorgmaticStatsCollector:
     
     def parse_database_listing(self, path: str) -> List[Dict]:
         """Parse database backup information from archive listing"""
-        command = f"borgmatic list --archive latest --find *borgmatic/*_databases"
-        output = self.run_docker_command(command)
+        output = self.run_docker_command(
+            ["borgmatic", "list", "--archive", "latest", "--find", "*borgmatic/*_databases"]
+        )
         
-        databases = []
-        if output:
-            for line in output.split('\n'):
-                # Parse database backup entries
-                if 'borgmatic/mariadb_databases/' in line or 'borgmatic/postgresql_databases/' in line:
-                    parts = line.split()
-                    if len(parts) >= 7:
-                        path_parts = parts[-1].split('/')
-                        if len(path_parts) >= 3:
-                            db_type = path_parts[1].replace('_databases', '')
-                            if db_type == 'mariadb':
-                                db_type = 'mariadb'
-                            elif db_type == 'postgresql':
-                                db_type = 'postgresql'
-                            
-                            # Check if it's a file (database dump)
-                            if parts[0].startswith('-'):
-                                databases.append({
-                                    'type': db_type,
-                                    'name': path_parts[-1],
-                                    'container': path_parts[-2] if len(path_parts) > 3 else None,
-                                    'size': int(parts[4]) if parts[4].isdigit() else 0,
-                                    'path': parts[-1]
-                                })
+        if not output:
+            return []
         
-        return databases
-    
-    def upsert_repository(self, repo_data: Dict) -> int:
-        """Insert or update repository and return its ID"""
-        self.cursor.execute("""
-            INSERT INTO repositories (name, path, location_type, repository_id, encryption_mode, size_on_disk_bytes, last_modified)
-            VALUES (%s, %s, %s, %s, %s, %s, %s)
-            ON CONFLICT (repository_id)
-            DO UPDATE SET
-                size_on_disk_bytes = EXCLUDED.size_on_disk_bytes,
-                last_modified = EXCLUDED.last_modified,
-                updated_at = CURRENT_TIMESTAMP
-            RETURNING id
-        """, (
-            repo_data['label'],
-            repo_data['location'],
-            repo_data['location_type'],
-            repo_data['id'],
-            repo_data.get('encryption_mode'),
-            repo_data.get('size_on_disk_bytes'),
-            repo_data.get('last_modified')
-        ))
-        return self.cursor.fetchone()['id']
-    
-    def insert_repository_stats(self, repo_id: int, stats: Dict):
-        """Insert repository statistics"""
-        self.cursor.execute("""
-            INSERT INTO repository_stats (
-                repository_id, total_archives, total_size_bytes,
-                total_compressed_size_bytes, total_deduplicated_size_bytes,
-                unique_chunks, total_chunks, unique_csize, total_csize,
-                compression_ratio, deduplication_ratio
-            ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-        """, (
-            repo_id,
-            stats['total_archives'],
-            stats['total_size'],
-            stats['total_compressed'],
-            stats['total_deduplicated'],
-            stats.get('unique_chunks'),
-            stats.get('total_chunks'),
-            stats.get('unique_csize'),
-            stats.get('total_csize'),
-            stats.get('compression_ratio'),
-            stats.get('deduplication_ratio')
-        ))
+        return [{
+            'type': m.group(3).decode(),
+            'name': m.group(5).decode(errors='replace'),
+            'container': m.group(4).decode(errors='replace') if m.group(4) else None,
+            'size': int(m.group(1)),
+            'path': m.group(2).decode(errors='replace')
+        } for m in DATABASE_DUMP_RE.finditer(output)]
     
-    def insert_archive(self, repo_id: int, archive: Dict) -> int:
-        """Insert archive and return its ID"""
+    def store_repository(self, repo_data: Dict, stats: Dict, config: Optional[Dict],
+                         info_hash: str) -> Tuple[int, Optional[str]]:
+        """Upsert repository with its stats, pruning config, sources and info hash
+
+        Returns the repository ID and the info hash recorded by the previous run.
+        """
+        config = config or {}
         self.cursor.execute("""
-            INSERT INTO backup_archives (
-                repository_id, archive_name, archive_hash, hostname,
-                username, comment, created_at, end_time, duration_seconds,
-                original_size_bytes, compressed_size_bytes, deduplicated_size_bytes,
-                number_of_files
-            ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            ON CONFLICT (repository_id, archive_hash) 
-            DO UPDATE SET recorded_at = CURRENT_TIMESTAMP
-            RETURNING id
-        """, (
-            repo_id,
-            archive['name'],
-            archive['id'],
-            archive.get('hostname'),
-            archive.get('username'),
-            archive.get('comment', ''),
-            archive['start'],
-            archive.get('end'),
-            archive.get('duration'),
-            archive['stats']['original_size'],
-            archive['stats']['compressed_size'],
-            archive['stats']['deduplicated_size'],
-            archive['stats']['nfiles']
-        ))
-        return self.cursor.fetchone()['id']
-    
-    def insert_backup_sources(self, repo_id: int, sources: List[str]):
-        """Insert backup source directories"""
-        for source in sources:
-            self.cursor.execute("""
+            WITH repo AS (
+                INSERT INTO repositories (name, path, location_type, repository_id, encryption_mode, size_on_disk_bytes, last_modified)
+                VALUES (%(label)s, %(location)s, %(location_type)s, %(id)s, %(encryption_mode)s, %(size_on_disk_bytes)s, %(last_modified)s)
+                ON CONFLICT (repository_id)
+                DO UPDATE SET
+                    size_on_disk_bytes = EXCLUDED.size_on_disk_bytes,
+                    last_modified = EXCLUDED.last_modified,
+                    updated_at = CURRENT_TIMESTAMP
+                RETURNING id
+            ), stats_ins AS (
+                INSERT INTO repository_stats (
+                    repository_id, total_archives, total_size_bytes,
+                    total_compressed_size_bytes, total_deduplicated_size_bytes,
+                    unique_chunks, total_chunks, unique_csize, total_csize,
+                    compression_ratio, deduplication_ratio
+                )
+                SELECT id, %(total_archives)s, %(total_size)s, %(total_compressed)s,
+                    %(total_deduplicated)s, %(unique_chunks)s, %(total_chunks)s,
+                    %(unique_csize)s, %(total_csize)s, %(compression_ratio)s,
+                    %(deduplication_ratio)s
+                FROM repo
+            ), prune_ins AS (
+                INSERT INTO pruning_config (
+                    repository_id, keep_daily, keep_weekly,
+                    keep_monthly, keep_yearly, keep_within
+                )
+                SELECT id, %(keep_daily)s, %(keep_weekly)s, %(keep_monthly)s,
+                    %(keep_yearly)s, %(keep_within)s
+                FROM repo
+                WHERE %(has_config)s
+                ON CONFLICT (repository_id) 
+                DO UPDATE SET 
+                    keep_daily = EXCLUDED.keep_daily,
+                    keep_weekly = EXCLUDED.keep_weekly,
+                    keep_monthly = EXCLUDED.keep_monthly,
+                    keep_yearly = EXCLUDED.keep_yearly,
+                    keep_within = EXCLUDED.keep_within,
+                    updated_at = CURRENT_TIMESTAMP
+            ), src_ins AS (
                 INSERT INTO backup_sources (repository_id, source_path)
-                VALUES (%s, %s)
+                SELECT repo.id, source_path
+                FROM repo, unnest(%(sources)s::text[]) AS source_path
                 ON CONFLICT (repository_id, source_path) DO NOTHING
-            """, (repo_id, source))
+            ), state_ins AS (
+                INSERT INTO collector_state (repository_id, last_info_hash)
+                SELECT id, %(info_hash)s
+                FROM repo
+                ON CONFLICT (repository_id)
+                DO UPDATE SET
+                    last_info_hash = EXCLUDED.last_info_hash,
+                    updated_at = CURRENT_TIMESTAMP
+            )
+            -- Sub-statements share one snapshot, so this still sees the previous hash
+            SELECT repo.id, collector_state.last_info_hash
+            FROM repo
+            LEFT JOIN collector_state ON collector_state.repository_id = repo.id
+        """, {
+            'label': repo_data['label'],
+            'location': repo_data['location'],
+            'location_type': repo_data['location_type'],
+            'id': repo_data['id'],
+            'encryption_mode': repo_data.get('encryption_mode'),
+            'size_on_disk_bytes': repo_data.get('size_on_disk_bytes'),
+            'last_modified': repo_data.get('last_modified'),
+            'total_archives': stats['total_archives'],
+            'total_size': stats['total_size'],
+            'total_compressed': stats['total_compressed'],
+            'total_deduplicated': stats['total_deduplicated'],
+            'unique_chunks': stats.get('unique_chunks'),
+            'total_chunks': stats.get('total_chunks'),
+            'unique_csize': stats.get('unique_csize'),
+            'total_csize': stats.get('total_csize'),
+            'compression_ratio': stats.get('compression_ratio'),
+            'deduplication_ratio': stats.get('deduplication_ratio'),
+            'has_config': bool(config),
+            'keep_daily': config.get('keep_daily'),
+            'keep_weekly': config.get('keep_weekly'),
+            'keep_monthly': config.get('keep_monthly'),
+            'keep_yearly': config.get('keep_yearly'),
+            'keep_within': config.get('keep_within'),
+            'sources': list(config.get('source_directories') or []),
+            'info_hash': info_hash
+        })
+        repo_id, last_info_hash = self.cursor.fetchone()
+        return repo_id, last_info_hash
     
-    def insert_pruning_config(self, repo_id: int, config: Dict):
-        """Insert pruning configuration"""
-        self.cursor.execute("""
-            INSERT INTO pruning_config (
-                repository_id, keep_daily, keep_weekly,
-                keep_monthly, keep_yearly, keep_within
-            ) VALUES (%s, %s, %s, %s, %s, %s)
-            ON CONFLICT (repository_id) 
-            DO UPDATE SET 
-                keep_daily = EXCLUDED.keep_daily,
-                keep_weekly = EXCLUDED.keep_weekly,
-                keep_monthly = EXCLUDED.keep_monthly,
-                keep_yearly = EXCLUDED.keep_yearly,
-                keep_within = EXCLUDED.keep_within,
-                updated_at = CURRENT_TIMESTAMP
-        """, (
-            repo_id,
-            config.get('keep_daily'),
-            config.get('keep_weekly'),
-            config.get('keep_monthly'),
-            config.get('keep_yearly'),
-            config.get('keep_within')
-        ))
+    def get_archive_ids(self, repo_id: int) -> Dict[str, int]:
+        """Return IDs of the repository's stored archives keyed by archive hash"""
+        self.cursor.execute(
+            "SELECT archive_hash, id FROM backup_archives WHERE repository_id = %s",
+            (repo_id,)
+        )
+        return dict(self.cursor.fetchall())
+    
+    def insert_archives_bulk(self, repo_id: int, archives: List[Dict]) -> Dict[str, int]:
+        """Insert archives in one statement and return their IDs keyed by archive hash"""
+        self.cursor.execute(
+            "EXECUTE assim_archives (%s, %s)",
+            (repo_id, Json(archives, dumps=json_dumps))
+        )
+        return {archive_hash: archive_id for archive_id, archive_hash in self.cursor.fetchall()}
     
-    def insert_database_backups(self, archive_id: int, databases: List[Dict]):
+    def insert_database_backups(self, archive_id: int, databases: List[Dict]) -> None:
         """Insert database backup information"""
-        for db in databases:
-            self.cursor.execute("""
-                INSERT INTO database_backups (
-                    archive_id, database_type, database_name,
-                    hostname, size_bytes, backup_path
-                ) VALUES (%s, %s, %s, %s, %s, %s)
-            """, (
-                archive_id,
-                db['type'],
-                db['name'],
-                db.get('container'),
-                db.get('size', 0),
-                db.get('path')
-            ))
+        self.cursor.execute("EXECUTE assim_database_backups (%s, %s, %s, %s, %s, %s)", (
+            archive_id,
+            [db['type'] for db in databases],
+            [db['name'] for db in databases],
+            [db.get('container') for db in databases],
+            [db.get('size', 0) for db in databases],
+            [db.get('path') for db in databases]
+        ))
     
-    def collect_and_store_stats(self):
+    def collect_and_store_stats(self) -> None:
         """Main collection and storage process"""
         try:
-            # Get borgmatic info
-            info_data = self.get_borgmatic_info()
-            if not info_data:
-                logger.error("Failed to get borgmatic info")
-                return
+            # Statistics can be recollected, so don't wait on the WAL flush at commit
+            self.cursor.execute("SET LOCAL synchronous_commit = off")
+            
+            # Start borgmatic info and fetch config and database backups
+            # concurrently; these are independent read-only commands
+            info_proc = self.open_borgmatic_info()
+            try:
+                with ThreadPoolExecutor(max_workers=2) as executor:
+                    config_future = executor.submit(self.get_borgmatic_config)
+                    databases_future = executor.submit(self.parse_database_listing, "/mnt/borg-repository")
+                    config = config_future.result()
+                    databases = databases_future.result()
+            except BaseException:
+                # Streaming never started, so stream_repositories won't reap it
+                info_proc.kill()
+                if info_proc.stdout:
+                    info_proc.stdout.close()
+                info_proc.wait()
+                raise
             
-            # Get borgmatic config
-            config = self.get_borgmatic_config()
             if not config:
                 logger.warning("Failed to get borgmatic config")
             
-            # Get database backups info
-            databases = self.parse_database_listing("/mnt/borg-repository")
-            
-            # Process each repository
-            for repo_info in info_data:
-                repo_data = repo_info['repository']
-                repo_data['label'] = repo_data.get('label', 'unknown')
-                
-                # Determine if remote
-                is_remote = repo_data['location'].startswith('ssh://')
-                repo_data['location_type'] = 'remote' if is_remote else 'local'
-                
-                # Get encryption info
-                repo_data['encryption_mode'] = repo_info.get('encryption', {}).get('mode')
+            # Process each repository as it is parsed from the info stream
+            repo_count = 0
+            # Close the stream explicitly so the borgmatic process is reaped
+            # even when the loop body raises; compiled builds do not finalise
+            # abandoned generators
+            with closing(self.stream_repositories(info_proc)) as repos:
+                for repo_info in repos:
+                    repo_count += 1
+                    # Hash the entry as borgmatic reported it, before it is annotated below
+                    info_hash = hashlib.blake2b(json_dumps(repo_info, sort_keys=True).encode(), digest_size=16).hexdigest()
+                    repo_data = repo_info['repository']
+                    repo_data['label'] = repo_data.get('label', 'unknown')
+                    
+                    # Determine if remote
+                    is_remote = repo_data['location'].startswith('ssh://')
+                    repo_data['location_type'] = 'remote' if is_remote else 'local'
+                    
+                    # Get encryption info
+                    repo_data['encryption_mode'] = repo_info.get('encryption', {}).get('mode')
 
-                # Get repository size on disk
-                repo_data['size_on_disk_bytes'] = self.get_repository_size(repo_data['location'])
-                if repo_data['size_on_disk_bytes']:
-                    logger.info(f"Repository {repo_data['label']} size on disk: {repo_data['size_on_disk_bytes']} bytes")
+                    # Get repository size on disk
+                    repo_data['size_on_disk_bytes'] = self.get_repository_size(repo_data['location'])
+                    if repo_data['size_on_disk_bytes']:
+                        logger.info(f"Repository {repo_data['label']} size on disk: {repo_data['size_on_disk_bytes']} bytes")
 
-                # Upsert repository
-                repo_id = self.upsert_repository(repo_data)
-                logger.info(f"Processing repository: {repo_data['label']} (ID: {repo_id})")
-                
-                # Calculate statistics
-                total_original = 0
-                total_compressed = 0
-                total_deduplicated = 0
-                
-                # Process archives
-                archives = repo_info.get('archives', [])
-                for archive in archives:
-                    archive_id = self.insert_archive(repo_id, archive)
+                    # Calculate statistics
+                    total_original: int = 0
+                    total_compressed: int = 0
+                    total_deduplicated: int = 0
                     
-                    # Add database backups for latest archive
-                    if archive['name'] == archives[-1]['name'] and databases:
-                        self.insert_database_backups(archive_id, databases)
+                    archives = repo_info.get('archives', [])
+                    for archive in archives:
+                        # Accumulate totals
+                        total_original += archive['stats']['original_size']
+                        total_compressed += archive['stats']['compressed_size']
+                        total_deduplicated += archive['stats']['deduplicated_size']
                     
-                    # Accumulate totals
-                    total_original += archive['stats']['original_size']
-                    total_compressed += archive['stats']['compressed_size']
-                    total_deduplicated += archive['stats']['deduplicated_size']
-                
-                # Calculate ratios
-                compression_ratio = None
-                deduplication_ratio = None
-                if total_original > 0:
-                    compression_ratio = round((1 - total_compressed / total_original) * 100, 2)
-                    deduplication_ratio = round((1 - total_deduplicated / total_original) * 100, 2)
-                
-                # Get cache stats
-                cache_stats = repo_info.get('cache', {}).get('stats', {})
-                
-                # Insert repository stats
-                stats = {
-                    'total_archives': len(archives),
-                    'total_size': total_original,
-                    'total_compressed': total_compressed,
-                    'total_deduplicated': total_deduplicated,
-                    'unique_chunks': cache_stats.get('total_unique_chunks'),
-                    'total_chunks': cache_stats.get('total_chunks'),
-                    'unique_csize': cache_stats.get('unique_csize'),
-                    'total_csize': cache_stats.get('total_csize'),
-                    'compression_ratio': compression_ratio,
-                    'deduplication_ratio': deduplication_ratio
-                }
-                self.insert_repository_stats(repo_id, stats)
-                
-                # Insert config data if available
-                if config:
-                    # Insert source directories
-                    if 'source_directories' in config:
-                        self.insert_backup_sources(repo_id, config['source_directories'])
+                    # Calculate ratios
+                    compression_ratio = None
+                    deduplication_ratio = None
+                    if total_original > 0:
+                        compression_ratio = round((1 - total_compressed / total_original) * 100, 2)
+                        deduplication_ratio = round((1 - total_deduplicated / total_original) * 100, 2)
                     
-                    # Insert pruning config
-                    pruning = {
-                        'keep_daily': config.get('keep_daily'),
-                        'keep_weekly': config.get('keep_weekly'),
-                        'keep_monthly': config.get('keep_monthly'),
-                        'keep_yearly': config.get('keep_yearly'),
-                        'keep_within': config.get('keep_within')
+                    # Get cache stats
+                    cache_stats = repo_info.get('cache', {}).get('stats', {})
+                    
+                    stats = {
+                        'total_archives': len(archives),
+                        'total_size': total_original,
+                        'total_compressed': total_compressed,
+                        'total_deduplicated': total_deduplicated,
+                        'unique_chunks': cache_stats.get('total_unique_chunks'),
+                        'total_chunks': cache_stats.get('total_chunks'),
+                        'unique_csize': cache_stats.get('unique_csize'),
+                        'total_csize': cache_stats.get('total_csize'),
+                        'compression_ratio': compression_ratio,
+                        'deduplication_ratio': deduplication_ratio
                     }
-                    self.insert_pruning_config(repo_id, pruning)
+                    
+                    # Upsert repository together with its stats, pruning config
+                    # and source directories in a single round-trip
+                    repo_id, last_info_hash = self.store_repository(repo_data, stats, config, info_hash)
+                    logger.info(f"Processing repository: {repo_data['label']} (ID: {repo_id})")
+                    
+                    if info_hash == last_info_hash:
+                        logger.info(f"Repository {repo_data['label']} unchanged since last run, skipping archives")
+                        continue
+                    
+                    # Borg archives are immutable, so only send ones not stored yet
+                    archive_ids = self.get_archive_ids(repo_id)
+                    new_archives = [archive for archive in archives if archive['id'] not in archive_ids]
+                    if new_archives:
+                        logger.info(f"Inserting {len(new_archives)} new archive(s) for {repo_data['label']}")
+                        archive_ids.update(self.insert_archives_bulk(repo_id, new_archives))
+                
+                    # Add database backups for latest archive
+                    if archives and databases:
+                        self.insert_database_backups(archive_ids[archives[-1]['id']], databases)
+            
+            if not repo_count:
+                logger.error("Failed to get borgmatic info")
+                return
             
             # Commit all changes
             self.conn.commit()
             logger.info("All statistics successfully stored in database")
             
             # Log summary
-            self.cursor.execute("SELECT * FROM backup_summary")
-            summary = self.cursor.fetchall()
-            for row in summary:
-                logger.info(f"Repository: {row['repository_name']} ({row['location_type']})")
-                logger.info(f"  - Total backups: {row['total_backups']}")
-                logger.info(f"  - Last backup: {row['last_backup_time']}")
-                logger.info(f"  - Hours since last: {row['hours_since_last_backup']:.1f}")
+            self.cursor.execute("""
+                SELECT format(
+                    E'Repository: %s (%s)\\n  - Total backups: %s\\n  - Last backup: %s\\n  - Hours since last: %s',
+                    repository_name, location_type, total_backups, last_backup_time,
+                    round(hours_since_last_backup::numeric, 1)
+                )
+                FROM backup_summary
+            """)
+            for row in self.cursor.fetchall():
+                logger.info(row[0])
                 
         except Exception as e:
             logger.error(f"Error collecting stats: {e}")
@@ -421,12 +636,18 @@ class BorgmaticStatsCollector:
             raise
 
 
-def main():
+def main() -> None:
     """Main entry point"""
     collector = BorgmaticStatsCollector()
     
+    if YAML_LOADER is not yaml.SafeLoader:
+        logger.info("Using libyaml CSafeLoader for config parsing")
+    else:
+        logger.info("libyaml not available, using pure-Python SafeLoader for config parsing")
+    
     try:
         collector.connect_db()
+        collector.release_docker_shell(collector.start_docker_shell())
         collector.collect_and_store_stats()
     except KeyboardInterrupt:
         logger.info("Collection interrupted by user")
@@ -434,6 +655,7 @@ def main():
         logger.error(f"Fatal error: {e}")
         sys.exit(1)
     finally:
+        collector.stop_docker_shells()
         collector.close_db()
 
 
@@ -7,6 +7,7 @@ DROP TABLE IF EXISTS repository_stats CASCADE;
 DROP TABLE IF EXISTS backup_sources CASCADE;
 DROP TABLE IF EXISTS database_backups CASCADE;
 DROP TABLE IF EXISTS pruning_config CASCADE;
+DROP TABLE IF EXISTS collector_state CASCADE;
 DROP TABLE IF EXISTS repositories CASCADE;
 
 -- Create repositories table to track different backup repositories
@@ -95,6 +96,13 @@ CREATE TABLE pruning_config (
     UNIQUE(repository_id)
 );
 
+-- Create table for collector bookkeeping between runs
+CREATE TABLE collector_state (
+    repository_id INTEGER PRIMARY KEY REFERENCES repositories(id) ON DELETE CASCADE,
+    last_info_hash VARCHAR(64), -- Hash of the repository's borgmatic info output
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+);
+
 -- Create summary statistics view
 CREATE VIEW backup_summary AS
 SELECT 